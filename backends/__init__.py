@@ -0,0 +1,24 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''Cache and task queue backends used by coverfm:
+    cache - memcache-like client (get, set, get_multi, set_multi, delete,
+        delete_multi, incr);
+    tasks - task queue client (add, add_multi of named tasks).
+
+App Engine services are used by default. Setting COVERFM_BACKEND environment
+variable (or config.BACKEND) to 'local' switches to backends.local, which is
+what standalone.py does. Datastore and urlfetch are reached through the App
+Engine API proxy, so in local mode they are provided by SDK stubs registered
+by backends.local.setup_stubs.'''
+
+import os
+
+import config
+
+BACKEND = os.environ.get('COVERFM_BACKEND', config.BACKEND)
+
+if BACKEND == 'local':
+    from backends.local import cache, tasks
+else:
+    from backends.appengine import cache, tasks
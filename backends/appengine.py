@@ -0,0 +1,35 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''App Engine backends: memcache and task queue services.'''
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+
+class AppEngineTasks(object):
+    '''Add tasks to App Engine task queues.'''
+    def add(self, url, params=None, queue_name='default', name=None):
+        taskqueue.add(url=url, params=params, queue_name=queue_name, name=name)
+
+    def add_multi(self, tasks, queue_name='default'):
+        '''Add (url, params, name) tasks by batches of taskqueue.MAX_TASKS_PER_ADD.
+        Tasks with names that were already used are skipped.'''
+        queue = taskqueue.Queue(queue_name)
+        tasks = [taskqueue.Task(url=url, params=params, name=name)
+                        for url, params, name in tasks]
+        for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            batch = tasks[i:i + taskqueue.MAX_TASKS_PER_ADD]
+            try:
+                queue.add(batch)
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                # the rest of the batch is added anyway
+                skipped = [task.name for task in batch if not task.was_enqueued]
+                logging.info('Skipped %d already added tasks' % len(skipped))
+
+
+# memcache module already has the interface of the cache backend
+cache = memcache
+tasks = AppEngineTasks()
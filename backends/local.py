@@ -0,0 +1,188 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''Local backends for running coverfm outside of App Engine (see standalone.py):
+    LocalCache - in-process cache;
+    MemcachedCache - memcached client, keeps the cache across restarts;
+    LocalTasks - task runner executing tasks against the WSGI application in
+        a background thread of the process that added them. Task names are
+        remembered for the process lifetime.'''
+
+import os
+import time
+import Queue
+import logging
+import threading
+import collections
+
+import config
+
+
+class LocalCache(object):
+    '''In-process memcache replacement with expiration and LRU eviction of
+    entries beyond config.LOCAL_CACHE_ITEMS. Values are stored as is, so
+    they must not be mutated after set.'''
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def get_multi(self, keys, key_prefix=''):
+        with self.lock:
+            found = {}
+            for key in keys:
+                value = self._get(key_prefix + key)
+                if value is not None:
+                    found[key] = value
+            return found
+
+    def set(self, key, value, time=0):
+        with self.lock:
+            self._set(key, value, time)
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        with self.lock:
+            for key, value in mapping.iteritems():
+                self._set(key_prefix + key, value, time)
+        return []
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+        return True
+
+    def delete_multi(self, keys, key_prefix=''):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key_prefix + key, None)
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self.lock:
+            value = self._get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            value += delta
+            self._set(key, value, 0)
+            return value
+
+    def _get(self, key):
+        item = self.items.pop(key, None)
+        if item is None:
+            return None
+        value, expires = item
+        if expires and expires < time.time():
+            return None
+        self.items[key] = item
+        return value
+
+    def _set(self, key, value, ttl):
+        self.items.pop(key, None)
+        self.items[key] = (value, time.time() + ttl if ttl else None)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+class MemcachedCache(object):
+    '''memcached client with App Engine memcache interface (python-memcached
+    has the same one except incr with initial_value).'''
+    def __init__(self, servers):
+        import memcache
+        self.client = memcache.Client(servers)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def incr(self, key, delta=1, initial_value=None):
+        value = self.client.incr(key, delta)
+        if value is None and initial_value is not None:
+            value = initial_value + delta
+            if not self.client.add(key, value):
+                value = self.client.incr(key, delta)
+        return value
+
+
+class LocalTasks(object):
+    '''Run tasks by posting them to the WSGI application in a background thread.
+    Queue rates aren't respected, tasks are run one by one in order they were added.
+    The application is set by the module serving it (see standalone.py).'''
+    def __init__(self):
+        self.application = None
+        self.queue = Queue.Queue()
+        self.worker = None
+        self.names = set()
+        self.lock = threading.Lock()
+
+    def add(self, url, params=None, queue_name='default', name=None):
+        with self.lock:
+            if name is not None:
+                if name in self.names:
+                    logging.info('Skipped already added task %s' % name)
+                    return
+                self.names.add(name)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='tasks')
+                self.worker.daemon = True
+                self.worker.start()
+        self.queue.put((url, params or {}, queue_name, name))
+
+    def add_multi(self, tasks, queue_name='default'):
+        for url, params, name in tasks:
+            self.add(url, params, queue_name, name)
+
+    def run(self):
+        while True:
+            url, params, queue_name, name = self.queue.get()
+            try:
+                self.execute(url, params, queue_name, name)
+            except Exception, e:
+                logging.exception(e)
+
+    def execute(self, url, params, queue_name, name=None):
+        import webob
+
+        name = name or 'task%d' % int(time.time() * 1000)
+        request = webob.Request.blank(url, POST=params, headers={
+            'X-AppEngine-TaskName': name,
+            'X-AppEngine-QueueName': queue_name})
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(self.application)
+        if response.status_int >= 400:
+            logging.error('Task %s failed: %s %s' % (name, url, response.status))
+
+
+def setup_stubs(app_id=config.LOCAL_APP_ID):
+    '''Register App Engine SDK stubs for services used through the API proxy:
+    datastore (stored in config.LOCAL_DATASTORE_PATH SQLite database),
+    urlfetch and users. The datastore stub supports a single process only,
+    several processes sharing the database file race in transactions.'''
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import urlfetch_stub
+    from google.appengine.api import user_service_stub
+    from google.appengine.datastore import datastore_sqlite_stub
+
+    os.environ.setdefault('APPLICATION_ID', app_id)
+    os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+    os.environ.setdefault('SERVER_SOFTWARE', 'Development/coverfm-standalone')
+
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+                    datastore_sqlite_stub.DatastoreSqliteStub(app_id,
+                                    config.LOCAL_DATASTORE_PATH))
+    apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+
+
+if config.LOCAL_MEMCACHED:
+    cache = MemcachedCache(config.LOCAL_MEMCACHED)
+else:
+    cache = LocalCache(config.LOCAL_CACHE_ITEMS)
+
+tasks = LocalTasks()
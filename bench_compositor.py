@@ -0,0 +1,67 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''Compare PIL and numpy topart compositors on 2x1 .. 5x5 grids:
+
+    python bench_compositor.py [repeat]
+
+Every run composes random artworks and encodes the canvas to PNG once. Both
+composing and total (composing + encoding) times are reported.'''
+
+from __future__ import division
+
+import os
+import sys
+import time
+
+from StringIO import StringIO
+from PIL import Image
+
+import compositor
+
+ABOUT_ME_WIDTH = 300
+ARTWORK_SIZE = 126
+
+
+def random_artwork(size):
+    data = os.urandom(size * size * 3)
+    return Image.frombuffer('RGB', (size, size), data, 'raw', 'RGB', 0, 1).copy()
+
+
+def run(compose, width, height, repeat):
+    '''Return best composing and total times in ms.'''
+    size = ABOUT_ME_WIDTH // width
+    best = None
+    for _ in xrange(repeat):
+        images = [random_artwork(ARTWORK_SIZE) for _ in xrange(width * height)]
+        start = time.time()
+        canvas = compose(images, width, height, size)
+        composed = time.time()
+        output = StringIO()
+        canvas.save(output, format='PNG')
+        output.close()
+        finished = time.time()
+        times = ((composed - start) * 1000, (finished - start) * 1000)
+        best = times if best is None else min(best, times)
+    return best
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    if compositor.numpy is None:
+        print 'numpy is not installed'
+        return
+
+    print '%-6s %22s %22s' % ('', 'compose, ms', 'compose + png, ms')
+    print '%-6s %10s %11s %10s %11s' % ('grid', 'pil', 'numpy', 'pil', 'numpy')
+    for width in xrange(2, 6):
+        for height in xrange(1, 6):
+            pil = run(compositor.compose_pil, width, height, repeat)
+            vec = run(compositor.compose_numpy, width, height, repeat)
+            print '%-6s %10.2f %11.2f %10.2f %11.2f' % (('%dx%d' % (width, height),)
+                        + pil[:1] + vec[:1] + pil[1:] + vec[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''TopArt grid compositors. Kept free of App Engine imports so they can be
+benchmarked locally (see bench_compositor.py).'''
+
+from __future__ import division
+
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def compose_pil(images, width, height, size):
+    '''Return RGBA canvas with images pasted one by one into width x height grid.'''
+    canvas = Image.new('RGBA', (size * width, size * height))
+
+    for index, image in enumerate(images):
+        append_image(canvas, image, index, width, size)
+
+    return canvas
+
+
+def compose_numpy(images, width, height, size):
+    '''Return RGBA canvas with images laid out into width x height grid with a
+    single vectorized pass over one preallocated array.'''
+    grid = numpy.zeros((height * width, size, size, 4), dtype=numpy.uint8)
+    for index, image in enumerate(images):
+        grid[index] = numpy.asarray(make_tile(image, size).convert('RGBA'))
+
+    # (row, column, y, x, band) -> (row, y, column, x, band) -> canvas rows
+    grid = grid.reshape(height, width, size, size, 4).transpose(0, 2, 1, 3, 4)
+    return Image.fromarray(grid.reshape(height * size, width * size, 4), 'RGBA')
+
+
+def compose(images, width, height, size, use_numpy=True):
+    '''Return RGBA canvas with images placed into width x height grid. Use numpy
+    compositor if it is available and allowed.'''
+    if use_numpy and numpy is not None:
+        return compose_numpy(images, width, height, size)
+    return compose_pil(images, width, height, size)
+
+
+def append_image(canvas, image, index, width, size):
+    left = (index % width) * size
+    top = (index // width) * size
+
+    canvas.paste(make_tile(image, size), (left, top))
+
+
+def make_tile(image, size):
+    '''Cut size x size square tile from the artwork image.'''
+    image.thumbnail((size, 'auto'))
+    return image.crop((0, 0, size, size))
@@ -1,6 +1,8 @@
 #!usr/bin/env python
 # Author: Kirill Lashuk
 
+import datetime
+
 import lastfm_api_info
 from libs import pylast
 
@@ -29,3 +31,121 @@ UPDATE_LIMIT = 500
 
 # Batch db.put limit of entities
 BATCH_PUT_LIMIT = 300   # Actual quota is 500 entities
+
+# Max number of simultaneous artwork downloads
+FETCH_CONCURRENCY = 10
+
+# Artwork download deadline in seconds
+FETCH_DEADLINE = 10
+
+# Max total size of artworks stored in the datastore cover cache (bytes)
+COVER_CACHE_LIMIT = 200 * 1024 * 1024
+
+# Min interval between updates of cached artwork last access time
+COVER_TOUCH_INTERVAL = datetime.timedelta(days=1)
+
+# Time broken artwork url is skipped for after its first failure (seconds)
+BAD_COVER_TTL = 3600
+
+# Max time broken artwork url is skipped for (seconds)
+BAD_COVER_MAX_TTL = 7 * 24 * 3600
+
+# Age of cached artwork after which it is revalidated with last.fm
+COVER_REVALIDATE_INTERVAL = datetime.timedelta(days=1)
+
+# Max artwork size in bytes, bigger artworks are rejected. It is well below
+# the datastore entity and memcache value limits (1 MB) cached artworks go to
+COVER_MAX_BYTES = 512 * 1024
+
+# Max artwork width or height in pixels, bigger artworks are rejected
+COVER_MAX_DIMENSION = 2000
+
+# Accepted artwork formats
+COVER_FORMATS = ('JPEG', 'PNG', 'GIF')
+
+# Compose toparts with numpy (needs numpy library in app.yaml, falls back to PIL
+# if numpy is unavailable). See bench_compositor.py before turning it on.
+NUMPY_COMPOSITOR = False
+
+# Quality of JPEG and WebP toparts
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+# Serve WebP topart for .png urls to clients that accept it
+NEGOTIATE_FORMAT = True
+
+# Number of toparts re-keyed by one migration task
+MIGRATE_BATCH_SIZE = 100
+
+# Look toparts up by nick, period and size when there is no topart keyed by its
+# url, turn off once /ad/migrate/keys has finished
+LEGACY_TOPART_LOOKUP = True
+
+# Interval between updates of toparts, depending on topart period
+UPDATE_INTERVALS = {
+    '7day': datetime.timedelta(hours=3),
+    '3month': datetime.timedelta(hours=12),
+    '6month': datetime.timedelta(days=1),
+    '12month': datetime.timedelta(days=2),
+    'overall': datetime.timedelta(days=3),
+}
+# Interval for periods missing in UPDATE_INTERVALS
+UPDATE_INTERVAL = datetime.timedelta(hours=3)
+
+# Update interval is multiplied by UPDATE_BACKOFF after every update in a row
+# that found album list unchanged or failed, up to UPDATE_MAX_BACKOFF times
+UPDATE_BACKOFF = 2
+UPDATE_MAX_BACKOFF = 8
+
+# Time clients may cache topart images for, depending on topart period (seconds)
+TOPART_MAX_AGE = {
+    '7day': 3 * 3600,
+    '3month': 6 * 3600,
+    '6month': 12 * 3600,
+    '12month': 24 * 3600,
+    'overall': 24 * 3600,
+}
+TOPART_MIN_MAX_AGE = 300
+
+# Max total size of topart images cached in memory of every instance (bytes)
+LOCAL_CACHE_SIZE = 16 * 1024 * 1024
+
+# Time locally cached topart image is served without checking its version (seconds)
+LOCAL_CACHE_TTL = 60
+
+# Number of toparts on one page of toparts list for admins and users
+ADMIN_PAGE_SIZE = 20
+USER_PAGE_SIZE = 10
+
+# Length of content hash in versioned topart image urls
+VERSION_LENGTH = 16
+
+# Time clients may cache versioned topart images for (seconds)
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+# Scales toparts are rendered in (ABOUT_ME_WIDTH * scale px wide), TopArtBlob has
+# properties for 1x and 2x only
+OUTPUT_SCALES = (1, 2)
+
+# Formats of scaled (not 1x) toparts, png is skipped to keep blobs small
+SCALED_FORMATS = ('jpg', 'webp')
+
+# Cache and task queue backends: 'appengine' or 'local' (see backends and standalone.py)
+BACKEND = 'appengine'
+
+# Local mode settings: application ID, SQLite datastore file, memcached servers
+# (e.g. ['127.0.0.1:11211'], in-process cache is used if empty) and max number
+# of entries in the in-process cache
+LOCAL_APP_ID = 'coverfm-hrd'
+LOCAL_DATASTORE_PATH = 'coverfm.sqlite'
+LOCAL_MEMCACHED = []
+LOCAL_CACHE_ITEMS = 10000
+
+# Update toparts sharing nick and period in one task
+COALESCE_UPDATES = True
+
+# Number of toparts added to update list by one scheduling task
+UPDATE_SLICE_SIZE = 100
+
+# Time after which update pass without progress is considered stalled and resumed
+UPDATE_PASS_TIMEOUT = datetime.timedelta(minutes=30)
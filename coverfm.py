@@ -4,7 +4,12 @@
 from __future__ import division
 
 import os
+import re
+import time
 import logging
+import collections
+import hashlib
+import email.utils
 import datetime
 import StringIO
 
@@ -12,10 +17,9 @@ from StringIO import StringIO
 from PIL import Image
 from libs import pylast
 
-from google.appengine.api import memcache
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch
 from google.appengine.api import users
-from google.appengine.api.labs import taskqueue
 
 from google.appengine.ext import db
 from google.appengine.ext import webapp
@@ -25,6 +29,12 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api.urlfetch import DownloadError
 
 import config
+import compositor
+
+from backends import cache
+from backends import tasks
+
+from compositor import make_tile
 
 # Application models
 
@@ -43,21 +53,62 @@ class Permission(db.Model):
     def has_permission(cls, user):
         return user is not None and Permission.all().filter('email =', user.email()).count() > 0
 
+class TopArtBlob(db.Model):
+    '''Store topart image variants (see get_image_variant) encoded in different
+    formats and scales. Blobs are shared between toparts with identical images:
+        refs - number of toparts referencing the blob.
+    Key name is the content hash of all variants (see get_topart_blob_key_name).'''
+    image = db.BlobProperty()
+    image_jpg = db.BlobProperty()
+    image_webp = db.BlobProperty()
+    image_jpg_2x = db.BlobProperty()
+    image_webp_2x = db.BlobProperty()
+    refs = db.IntegerProperty(default=1)
+
+    def get_image(self, variant):
+        '''Return topart image variant or None if it isn't available.'''
+        return getattr(self, get_image_property(variant), None)
+
+    @classmethod
+    def from_images(cls, key_name, images):
+        '''Create TopArtBlob from dict variant -> encoded topart.'''
+        values = dict((get_image_property(variant), image)
+                        for variant, image in images.iteritems())
+        return cls(key_name=key_name, **values)
+
+
 class TopArt(db.Model):
-    '''Store user's topart information:
+    '''Store user's topart information (key name is the topart url, see get_topart_url):
         nick - user's nick on last.fm;
-        owner - user's UserProperty.
+        owner - user's UserProperty;
+        blob - TopArtBlob with encoded topart images, so metadata can be read
+            and written without transferring images;
+        fingerprint - fingerprint of the album list the images are rendered
+            from (see get_arts_fingerprint);
+        next_update_at - time the auto-updated topart is due for update;
+        unchanged_updates - number of the last updates in a row that found
+            album list unchanged (see get_update_interval);
+        failed_updates - number of the last updates in a row that failed;
+        image, image_jpg, image_webp - legacy images stored in the topart itself
+            (moved to TopArtBlob by /ad/migrate/images).
     '''
     nick = db.StringProperty()
     owner = db.UserProperty()
     period = db.StringProperty()
     width = db.IntegerProperty()
     height = db.IntegerProperty()
+    blob = db.ReferenceProperty(TopArtBlob)
+    fingerprint = db.StringProperty(indexed=False)
     image = db.BlobProperty()
+    image_jpg = db.BlobProperty()
+    image_webp = db.BlobProperty()
     auto_upd = db.BooleanProperty(default=False)
     wait_for_upd = db.BooleanProperty(default=False)
     creation_date = db.DateTimeProperty(auto_now_add=True)
     last_upd_date = db.DateTimeProperty(auto_now_add=True)
+    next_update_at = db.DateTimeProperty()
+    unchanged_updates = db.IntegerProperty(default=0, indexed=False)
+    failed_updates = db.IntegerProperty(default=0, indexed=False)
 
     def url(self):
         '''Return url for this TopArt.'''
@@ -65,19 +116,213 @@ class TopArt(db.Model):
                         self.width, self.height)
 
     def id(self):
-        '''Return TopArt ID.'''
-        return self.key().id()
+        '''Return TopArt ID used in urls.'''
+        return str(self.key())
+
+    @classmethod
+    def get_by_url_id(cls, id):
+        '''Return TopArt by ID returned by id() or by numeric ID of a topart
+        that isn't migrated to a key name yet.'''
+        if id.isdigit():
+            return cls.get_by_id(int(id))
+        try:
+            return cls.get(id)
+        except (db.BadKeyError, db.KindError):
+            return None
+
+    def set_images(self, images):
+        '''Store dict format -> encoded topart returned by generate_topart
+        to the shared TopArtBlob with the same content. The previous blob is
+        released by finish_topart_updates once the topart is stored.'''
+        old_key = self.blob_key()
+        if old_key and old_key.name() == get_topart_blob_key_name(images):
+            return
+        self.blob = acquire_topart_blob(images)
+        if old_key:
+            self.replaced_blob = old_key
+
+    def get_image(self, variant):
+        '''Return topart image variant or None if it isn't available.'''
+        if self.blob:
+            return self.blob.get_image(variant)
+        # legacy topart which isn't migrated to TopArtBlob yet
+        return getattr(self, get_image_property(variant), None)
+
+    def find_image_variant(self, variant):
+        '''Return variant if it is available or the closest available one:
+        another format of the same scale, 1x png for 1x variants. Return None
+        if there are no images of the scale, so scaled images are never
+        substituted with 1x ones.'''
+        format, scale = split_image_variant(variant)
+        for fallback in (format, 'png', 'jpg', 'webp'):
+            if self.get_image(fallback + scale):
+                return fallback + scale
+        return None if scale else 'png'
+
+    def version(self):
+        '''Return version stamp of topart images, it changes on every update.'''
+        return self.last_upd_date.strftime('%Y%m%d%H%M%S%f')
+
+    def blob_key(self):
+        '''Return key of the TopArtBlob without fetching it.'''
+        return TopArt.blob.get_value_for_datastore(self)
+
+    def versioned_url(self, scale=''):
+        '''Return immutable url (without extension) of current topart images
+        of the scale, which includes their content hash, or None if topart blob
+        isn't content addressed.'''
+        key = self.blob_key()
+        if key and CONTENT_HASH_RE.match(key.name() or ''):
+            return '%s%s.%s' % (self.url(), scale, key.name()[:config.VERSION_LENGTH])
+
+    def embed_url(self, scale=''):
+        '''Return url (without extension) to embed topart with. Auto-updated
+        toparts are embedded by stable url, so they keep updating.'''
+        if self.auto_upd:
+            return self.url() + scale
+        return self.versioned_url(scale) or self.url() + scale
+
+    def embed_url_2x(self):
+        '''Return embed_url of 2x topart images (for srcset) or None if topart
+        was rendered without them.'''
+        if self.find_image_variant('jpg' + get_scale_suffix(2)):
+            return self.embed_url(get_scale_suffix(2))
+
+    def schedule_update(self, changed=True):
+        '''Set time of the next update depending on whether album list has
+        changed by the last one.'''
+        self.unchanged_updates = 0 if changed else (self.unchanged_updates or 0) + 1
+        self.failed_updates = 0
+        self.next_update_at = datetime.datetime.now() + get_update_interval(
+                        self.period, self.unchanged_updates)
+
+    def schedule_retry(self):
+        '''Set time of the next update after a failed one, backing off with every
+        failure in a row, so failing toparts don't crowd out healthy ones.'''
+        self.failed_updates = (self.failed_updates or 0) + 1
+        self.next_update_at = datetime.datetime.now() + get_update_interval(
+                        self.period, self.failed_updates)
 
     def __str__(self):
         return 'nick=%s, period=%s, size=%dx%d' % (self.nick,
                         self.period, self.width, self.height)
 
 
+class UpdatePass(db.Model):
+    '''Store progress of the toparts update pass (see UpdateAllTopArts):
+        cursor - cursor of the toparts query where the pass stopped;
+        scheduled - number of toparts added to update queue.
+    The only entity has key name 'current'.'''
+    started = db.DateTimeProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+    finished = db.DateTimeProperty()
+    cursor = db.TextProperty()
+    scheduled = db.IntegerProperty(default=0)
+
+    def __str__(self):
+        return 'started=%s, scheduled=%d, finished=%s' % (self.started,
+                        self.scheduled, self.finished)
+
+
+class CoverArt(db.Model):
+    '''Store downloaded artwork shared between all toparts:
+        url - artwork url on last.fm;
+        size - pylast size constant of the artwork;
+        data - raw image bytes;
+        bytes - length of the data used for size-aware eviction;
+        etag, last_modified - http validators of the downloaded artwork;
+        validated - last time the artwork was downloaded or revalidated;
+        last_access - last time the artwork was read from the datastore.
+    Key name is built by cover_key_name.'''
+    url = db.StringProperty(indexed=False)
+    size = db.IntegerProperty(indexed=False)
+    data = db.BlobProperty()
+    bytes = db.IntegerProperty()
+    etag = db.StringProperty(indexed=False)
+    last_modified = db.StringProperty(indexed=False)
+    validated = db.DateTimeProperty(indexed=False)
+    last_access = db.DateTimeProperty(auto_now_add=True)
+
+    def is_stale(self):
+        '''Return True if artwork should be revalidated before use.'''
+        return (self.validated is None or
+                    datetime.datetime.now() - self.validated > config.COVER_REVALIDATE_INTERVAL)
+
+
+# TopArtBlob key name built by get_topart_blob_key_name
+CONTENT_HASH_RE = re.compile('^[0-9a-f]{40}$')
+
+
+# TopArt properties shown in toparts list
+TOPART_LIST_PROPERTIES = ('nick', 'period', 'width', 'height', 'owner', 'last_upd_date')
+
+
+# Topart output formats: extension -> (content type, PIL format)
+TOPART_FORMATS = {
+    'png': ('image/png', 'PNG'),
+    'jpg': ('image/jpeg', 'JPEG'),
+    'webp': ('image/webp', 'WEBP'),
+}
+
+
+def get_scale_suffix(scale):
+    '''Return suffix of topart urls and image variants of the scale.'''
+    return '' if scale == 1 else '@%dx' % scale
+
+
+def get_image_variants():
+    '''Return all topart image variants. Variant is a format followed by a scale
+    suffix (e.g. 'png' or 'jpg@2x'). Scales other than 1 are encoded only in
+    config.SCALED_FORMATS to keep blobs small.'''
+    variants = []
+    for scale in config.OUTPUT_SCALES:
+        formats = TOPART_FORMATS if scale == 1 else config.SCALED_FORMATS
+        variants.extend(format + get_scale_suffix(scale) for format in formats)
+    return variants
+
+
+def get_stored_image_variant(variant):
+    '''Return variant if topart images are encoded in it, otherwise the first
+    encoded variant of the same scale. Return None if the scale isn't rendered.'''
+    variants = get_image_variants()
+    if variant in variants:
+        return variant
+    scale = split_image_variant(variant)[1]
+    for stored in variants:
+        if split_image_variant(stored)[1] == scale:
+            return stored
+    return None
+
+
+def split_image_variant(variant):
+    '''Return (format, scale suffix) of the image variant.'''
+    format, at, scale = variant.partition('@')
+    return format, at + scale
+
+
+def get_image_property(variant):
+    '''Return name of TopArtBlob (and legacy TopArt) property storing the variant.'''
+    format, scale = split_image_variant(variant)
+    name = 'image' if format == 'png' else 'image_' + format
+    if scale:
+        name += '_' + scale[1:]
+    return name
+
+
 def get_topart_url(nick, period, w, h):
     '''Generate url for TopArt with specific parameters.'''
     return '/topart/%s/%s/%dx%d' % (nick, period, w, h)
 
 
+def get_update_interval(period, backoffs=0):
+    '''Return interval between updates of topart of the period. The interval
+    grows config.UPDATE_BACKOFF times with every update in a row that found
+    album list unchanged or failed, up to config.UPDATE_MAX_BACKOFF times.'''
+    interval = config.UPDATE_INTERVALS.get(period, config.UPDATE_INTERVAL)
+    return interval * min(config.UPDATE_BACKOFF ** backoffs,
+                    config.UPDATE_MAX_BACKOFF)
+
+
 ##################################
 ## Application request handlers ##
 ##################################
@@ -158,17 +403,20 @@ class MainPage(BaseRequestHandler):
 
         # generate requested topart if there is no one already
         if not topart:
-            img, error = generate_topart(nick, period, w, h)
+            images, error, fingerprint = generate_topart(nick, period, w, h)
 
             if error:
                 return self.generate('index.html', {'error': error})
 
-            topart = TopArt(nick=nick, period=period, width=w, height=h)
+            topart = TopArt(key_name=get_topart_url(nick, period, w, h),
+                            nick=nick, period=period, width=w, height=h)
             topart.owner = users.get_current_user()
-            topart.image = img
+            topart.set_images(images)
+            topart.fingerprint = fingerprint
             topart.auto_upd = auto_upd
+            topart.schedule_update()
             topart.put()
-            memcache.set(topart.url(), topart, config.EXPIRATION_TIME)
+            cache.set(topart.url(), topart, config.EXPIRATION_TIME)
 
         self.redirect(topart.url())
 
@@ -210,13 +458,65 @@ class FAQ(BaseRequestHandler):
 
 
 class TopArtImage(BaseRequestHandler):
-    def get(self, nick, period, width, height):
+    def get(self, nick, period, width, height, scale, format):
         width = int(width)
         height = int(height)
-        topart = get_topart(nick, period, width, height)
-        if topart:
-            self.response.headers['Content-Type'] = 'image/png'
-            self.response.out.write(topart.image)
+        entry = get_topart_image(nick, period, width, height,
+                        self.choose_format(format) + (scale or ''))
+        if entry:
+            self.response.headers['Vary'] = 'Accept'
+            self.serve(entry, 'public, max-age=%d' % get_topart_max_age(entry['period']))
+        else:
+            self.error(404)
+
+    def serve(self, entry, cache_control):
+        headers = self.response.headers
+        headers['Content-Type'] = entry['content_type']
+        headers['ETag'] = '"%s"' % entry['etag']
+        headers['Last-Modified'] = format_http_date(entry['last_modified'])
+        headers['Cache-Control'] = cache_control
+
+        if self.not_modified(entry):
+            self.response.set_status(304)
+        else:
+            self.response.out.write(entry['image'])
+
+    def not_modified(self, entry):
+        '''Return True if client already has this version of the image.'''
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            return '*' in etags or '"%s"' % entry['etag'] in etags
+
+        if_modified_since = parse_http_date(self.request.headers.get('If-Modified-Since'))
+        return (if_modified_since is not None and
+                    entry['last_modified'].replace(microsecond=0) <= if_modified_since)
+
+    def choose_format(self, format):
+        '''Return format to serve topart in. Formats other than png are served
+        when requested by extension or (for png urls) when WebP is accepted by
+        client. get_topart_image falls back to png if format isn't available.'''
+        if (format == 'png' and config.NEGOTIATE_FORMAT
+                    and 'image/webp' in self.request.headers.get('Accept', '')):
+            format = 'webp'
+        return format
+
+
+class VersionedTopArtImage(TopArtImage):
+    '''Serve topart image by immutable url containing its content hash (see
+    TopArt.versioned_url) with far-future caching. Outdated versions and
+    versions of other length are redirected to the stable topart image url.'''
+    def get(self, nick, period, width, height, scale, version, format):
+        width = int(width)
+        height = int(height)
+        scale = scale or ''
+        entry = get_topart_image(nick, period, width, height, format + scale)
+        if not entry:
+            return self.error(404)
+        if version != (entry['blob'] or '')[:config.VERSION_LENGTH]:
+            return self.redirect('%s%s.%s' % (get_topart_url(nick, period, width, height),
+                            scale, format))
+        self.serve(entry, 'public, max-age=%d' % config.VERSIONED_MAX_AGE)
 
 
 class TopArtPage(BaseRequestHandler):
@@ -226,51 +526,102 @@ class TopArtPage(BaseRequestHandler):
         height = int(height)
         topart = get_topart(nick, period, width, height)
         if topart:
-            self.generate('topart_page.html', {'topart': topart, 'nick': topart.nick})
+            self.generate('topart_page.html', {'topart': topart, 'nick': topart.nick,
+                            'embed_url_2x': topart.embed_url_2x()})
         else:
             self.redirect('/toparts')
 
 
 class ManageTopArts(BaseRequestHandler):
-    '''TopArts managing page request handler.'''
+    '''TopArts managing page request handler. Toparts are listed page by page
+    with projection queries, so neither images nor unused fields are fetched.'''
     @BaseRequestHandler.authorized_only
     def get(self):
-        toparts = TopArt.all()
+        user = users.get_current_user()
         if users.is_current_user_admin():
+            toparts = db.Query(TopArt, projection=TOPART_LIST_PROPERTIES)
             toparts = toparts.order('last_upd_date')
-            toparts = toparts.fetch(20)
+            page_size = config.ADMIN_PAGE_SIZE
         else:
-            toparts = toparts.filter('owner =', users.get_current_user())
+            # owner is filtered by equality, so it can't be projected
+            toparts = db.Query(TopArt, projection=[name for name in TOPART_LIST_PROPERTIES
+                                                    if name != 'owner'])
+            toparts = toparts.filter('owner =', user)
             toparts = toparts.order('-last_upd_date')
-            toparts = toparts.fetch(10)
+            page_size = config.USER_PAGE_SIZE
+
+        cursor = self.request.get('cursor')
+        if cursor:
+            toparts.with_cursor(cursor)
+        page = toparts.fetch(page_size)
+        next_cursor = toparts.cursor() if len(page) == page_size else None
 
-        self.generate('toparts.html', { 'toparts': toparts })
+        if not users.is_current_user_admin():
+            for topart in page:
+                topart.owner = user
+
+        self.generate('toparts.html', {'toparts': page,
+                                       'cursor': cursor,
+                                       'next_cursor': next_cursor})
 
 
 class UpdateAllTopArts(BaseRequestHandler):
-    '''Add no more than config.UPDATE_LIMIT toparts to update task queue. Choose
-    toparts, that arn't waiting for update and haven't been updated for the longest time.'''
+    '''Start update pass adding no more than config.UPDATE_LIMIT toparts to update
+    task queue. Choose toparts, that arn't waiting for update and are due for
+    update by the pass start, the most overdue first. Toparts are scheduled by
+    UpdateSlice tasks, a pass that stopped halfway is resumed from its cursor.'''
     def get(self):
         logging.info('UPDATE all')
-        self.fill_update_queue()
+        self.start_pass()
         if not self.request.headers.get('X-AppEngine-Cron'):
             self.redirect('/toparts')
 
-    def fill_update_queue(self):
-        toparts = TopArt.all()
-        toparts = toparts.filter('auto_upd =', True)
-        toparts = toparts.filter('wait_for_upd =', False)
-        toparts = toparts.order('last_upd_date')
-        toparts = toparts.fetch(1000)
-
-        #logging.info('UPDATE fill taskqueue (size=%d)' % toparts.count())
+    def start_pass(self):
+        update_pass = UpdatePass.get_by_key_name('current')
+        now = datetime.datetime.now()
+        if update_pass and not update_pass.finished:
+            if now - update_pass.updated < config.UPDATE_PASS_TIMEOUT:
+                logging.info('UPDATE pass is in progress: %s' % update_pass)
+                return
+            logging.warning('UPDATE resuming stalled pass: %s' % update_pass)
+        else:
+            update_pass = UpdatePass(key_name='current', started=now)
+            update_pass.put()
+        tasks.add('/ad/update/slice')
 
-        tasks = [taskqueue.Task(url='/ad/update/%d' % topart.id()) for topart in toparts]
 
-        set_wait_for_upd(toparts, True)
+class UpdateSlice(BaseRequestHandler):
+    '''Schedule next config.UPDATE_SLICE_SIZE toparts of the current update pass
+    and chain the next slice until config.UPDATE_LIMIT toparts are scheduled or
+    there are no more toparts to update.'''
+    def post(self):
+        update_pass = UpdatePass.get_by_key_name('current')
+        if not update_pass or update_pass.finished:
+            return
 
-        for task in tasks:
-            task.add('update')
+        limit = min(config.UPDATE_SLICE_SIZE, config.UPDATE_LIMIT - update_pass.scheduled)
+        toparts = TopArt.all()
+        toparts = toparts.filter('auto_upd =', True)
+        toparts = toparts.filter('wait_for_upd =', False)
+        toparts = toparts.filter('next_update_at <=', update_pass.started)
+        toparts = toparts.order('next_update_at')
+        if update_pass.cursor:
+            toparts.with_cursor(update_pass.cursor)
+        batch = toparts.fetch(limit) if limit > 0 else []
+
+        set_wait_for_upd(batch, True)
+        enqueue_updates(batch, 'upd-%d' % time.mktime(update_pass.started.timetuple()))
+
+        update_pass.cursor = toparts.cursor() if batch else update_pass.cursor
+        update_pass.scheduled += len(batch)
+        if len(batch) < limit or update_pass.scheduled >= config.UPDATE_LIMIT:
+            update_pass.finished = datetime.datetime.now()
+        update_pass.put()
+
+        if update_pass.finished:
+            logging.info('UPDATE pass finished: %s' % update_pass)
+        else:
+            tasks.add('/ad/update/slice')
 
 
 class ResetAllWaitingUpdates(BaseRequestHandler):
@@ -282,18 +633,55 @@ class ResetAllWaitingUpdates(BaseRequestHandler):
         return self.redirect('/toparts')
 
 
+class EvictCovers(BaseRequestHandler):
+    '''Evict least recently used artworks from the cover cache.'''
+    def get(self):
+        evicted = evict_covers()
+        logging.info('EVICTED %d covers, cache stats: %s' % (evicted, cover_cache_stats()))
+        if not self.request.headers.get('X-AppEngine-Cron'):
+            self.redirect('/toparts')
+
+
 class UpdateTopArtRequestHandler(BaseRequestHandler):
-    def update_topart(self, topart):
-        img, error = generate_topart(topart.nick, topart.period,
-                        topart.width, topart.height)
-        if not error:
-            topart.image = img
+    def update_topart(self, topart, check_fingerprint=False):
+        return self.update_toparts([topart], check_fingerprint)[0]
+
+    def update_toparts(self, toparts, check_fingerprint=False):
+        '''Update toparts of the same nick and period rendering all of them
+        from one album list and covers fetch. If check_fingerprint is set
+        toparts which album list hasn't changed since the last render aren't
+        rendered again. Return list of apply_update results.'''
+        grids = list(set((topart.width, topart.height) for topart in toparts))
+        fingerprints = None
+        if check_fingerprint:
+            fingerprints = dict(((topart.width, topart.height), topart.fingerprint)
+                            for topart in toparts if topart.fingerprint)
+        results = generate_toparts(toparts[0].nick, toparts[0].period, grids, fingerprints)
+        return [self.apply_update(topart, *results[(topart.width, topart.height)])
+                        for topart in toparts]
+
+    def apply_update(self, topart, images, error, fingerprint):
+        '''Store update results in topart and schedule its next update. Topart
+        isn't put, callers put it and call finish_topart_updates. Images are None
+        if album list is unchanged, then only the next update is scheduled, so
+        topart version and cached images stay the same. Failed updates are
+        retried later.'''
+        if not error and images is None:
+            topart.schedule_update(changed=False)
+            logging.info('UNCHANGED %s' % topart)
+            return True
+        elif not error:
+            topart.schedule_update(changed=not fingerprint or
+                            fingerprint != topart.fingerprint)
+            topart.set_images(images)
+            topart.fingerprint = fingerprint
             topart.last_upd_date = datetime.datetime.now()
-            #logging.info('memcache.delete in UpdateTopArts')
-            memcache.delete(topart.url())
+            # cached images are dropped by finish_topart_updates after put
+            topart.updated = True
             logging.info('UPDATED %s' % topart)
             return True
         else:
+            topart.schedule_retry()
             logging.error('''UPDATE ERROR: %s\n Failed to update
                             %s  - generating error''' % (error, topart.id()))
             return False
@@ -302,12 +690,13 @@ class UpdateTopArtRequestHandler(BaseRequestHandler):
 class UpdateTopArt(UpdateTopArtRequestHandler):
     @BaseRequestHandler.authorized_only
     def get(self, id):
-        topart = TopArt.get_by_id(int(id))
+        topart = TopArt.get_by_url_id(id)
         if not topart:
             return self.redirect('/toparts')
         has_access = users.is_current_user_admin() or users.get_current_user() == topart.owner
         if has_access and self.update_topart(topart):
             topart.put()
+            finish_topart_updates([topart])
             return self.redirect(topart.url())
         else:
             return self.redirect('/toparts')
@@ -317,26 +706,45 @@ class UpdateTopArtTask(UpdateTopArtRequestHandler):
     def post(self, id):
         #logging.info(self.request.headers)
         if self.request.headers.get('X-AppEngine-TaskName'):
-            topart = TopArt.get_by_id(int(id))
+            topart = TopArt.get_by_url_id(id)
             if not topart:
-                logging.error('''UPDATE ERROR: Failed to update id=%d -
+                logging.error('''UPDATE ERROR: Failed to update id=%s -
                                 missing previous topart''' % id)
+                return
 
             if topart.wait_for_upd:
-                self.update_topart(topart)
+                self.update_topart(topart, check_fingerprint=True)
                 topart.wait_for_upd = False
                 topart.put()
+                finish_topart_updates([topart])
         else:
             return self.redirect('/')
 
 
+class UpdateTopArtGroupTask(UpdateTopArtRequestHandler):
+    '''Update toparts sharing nick and period (comma separated ids parameter)
+    in one task, see UpdateAllTopArts.'''
+    def post(self):
+        if not self.request.headers.get('X-AppEngine-TaskName'):
+            return self.redirect('/')
+
+        toparts = db.get(self.request.get('ids').split(','))
+        toparts = [topart for topart in toparts if topart and topart.wait_for_upd]
+        if not toparts:
+            return
+
+        self.update_toparts(toparts, check_fingerprint=True)
+        set_wait_for_upd(toparts, False)
+        finish_topart_updates(toparts)
+
+
 class DeleteTopArt(BaseRequestHandler):
     @BaseRequestHandler.authorized_only
     def get(self, id):
-        topart = TopArt.get_by_id(int(id))
+        topart = TopArt.get_by_url_id(id)
 
         if not topart:
-            logging.error('''DELETE ERROR: Failed to delete id=%d -
+            logging.error('''DELETE ERROR: Failed to delete id=%s -
                     missing topart''' % id)
             return self.redirect('/')
 
@@ -345,11 +753,122 @@ class DeleteTopArt(BaseRequestHandler):
 
         logging.info('DELETED: %s' % topart)
         topart.delete()
+        if topart.blob_key():
+            release_topart_blob(topart.blob_key())
+        uncache_toparts([topart.url()])
         self.redirect('/toparts')
 
 
+class MigrateTopArts(BaseRequestHandler):
+    '''Run one of the MIGRATIONS over all toparts. Every task processes
+    config.MIGRATE_BATCH_SIZE toparts and chains the next one.'''
+    def get(self, name):
+        tasks.add('/ad/migrate/%s' % name)
+        logging.info('MIGRATE %s started' % name)
+        return self.redirect('/toparts')
+
+    def post(self, name):
+        toparts = TopArt.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            toparts.with_cursor(cursor)
+        batch = toparts.fetch(config.MIGRATE_BATCH_SIZE)
+
+        migrated = MIGRATIONS[name](batch)
+        logging.info('MIGRATED %s of %d toparts' % (name, migrated))
+
+        if len(batch) == config.MIGRATE_BATCH_SIZE:
+            tasks.add('/ad/migrate/%s' % name, params={'cursor': toparts.cursor()})
+        else:
+            logging.info('MIGRATE %s finished' % name)
+
+
 # Useful functions
 
+def enqueue_updates(toparts, prefix):
+    '''Add update tasks for toparts to the update queue by batches. Toparts sharing
+    nick and period are updated by one task if config.COALESCE_UPDATES is set.
+    Task names are made of prefix and updated toparts ids, so repeated call with
+    the same prefix doesn't add the same tasks twice.'''
+    updates = []
+    if config.COALESCE_UPDATES:
+        groups = {}
+        for topart in toparts:
+            groups.setdefault((topart.nick, topart.period), []).append(topart.id())
+        for ids in groups.itervalues():
+            ids = ','.join(ids)
+            updates.append(('/ad/update/group', {'ids': ids}, ids))
+    else:
+        for topart in toparts:
+            updates.append(('/ad/update/%s' % topart.id(), None, topart.id()))
+    tasks.add_multi([(url, params, '%s-%s' % (prefix, hashlib.sha1(ids).hexdigest()))
+                            for url, params, ids in updates], queue_name='update')
+
+
+def migrate_topart_keys(toparts):
+    '''Copy toparts with numeric IDs to entities keyed by topart url and delete
+    the old ones. If topart with the same url is already keyed by name the old
+    duplicate is just deleted. Return number of migrated toparts.'''
+    old = [topart for topart in toparts if topart.key().name() is None]
+    if not old:
+        return 0
+
+    existing = TopArt.get_by_key_name([topart.url() for topart in old])
+    new = {}
+    for topart, current in zip(old, existing):
+        if not current and topart.url() not in new:
+            values = dict((name, getattr(topart, name)) for name in TopArt.properties())
+            new[topart.url()] = TopArt(key_name=topart.url(), **values)
+        elif topart.blob_key():
+            release_topart_blob(topart.blob_key())
+
+    db.put(new.values())
+    db.delete(old)
+    uncache_toparts([topart.url() for topart in old])
+
+    return len(new)
+
+
+def migrate_topart_images(toparts):
+    '''Move legacy images stored in toparts to TopArtBlob entities.
+    Return number of migrated toparts.'''
+    old = [topart for topart in toparts if topart.image]
+    if not old:
+        return 0
+
+    for topart in old:
+        topart.blob = acquire_topart_blob({'png': topart.image,
+                        'jpg': topart.image_jpg, 'webp': topart.image_webp})
+        topart.image = topart.image_jpg = topart.image_webp = None
+    db.put(old)
+    uncache_toparts([topart.url() for topart in old])
+
+    return len(old)
+
+
+def migrate_topart_schedule(toparts):
+    '''Set next_update_at of toparts updated before it was introduced, so they
+    are scheduled one update interval after their last update.
+    Return number of migrated toparts.'''
+    old = [topart for topart in toparts if topart.next_update_at is None]
+    if not old:
+        return 0
+
+    for topart in old:
+        topart.next_update_at = topart.last_upd_date + get_update_interval(topart.period)
+    db.put(old)
+    uncache_toparts([topart.url() for topart in old])
+
+    return len(old)
+
+
+MIGRATIONS = {
+    'keys': migrate_topart_keys,
+    'images': migrate_topart_images,
+    'schedule': migrate_topart_schedule,
+}
+
+
 def set_wait_for_upd(toparts, state):
     storage = []
     for topart in toparts:
@@ -365,102 +884,774 @@ def set_wait_for_upd(toparts, state):
 
 def get_topart(nick, period, w, h, use_cache=True):
     key = get_topart_url(nick, period, w, h)
-    topart = memcache.get(key) if use_cache else None
+    topart = cache.get(key) if use_cache else None
     if not topart:
-        toparts = TopArt.all()
-        toparts.filter('nick =', nick)
-        toparts.filter('period =', period)
-        toparts.filter('width =', w)
-        toparts.filter('height =', h)
-        toparts = toparts.fetch(1)
-        topart = toparts[0] if toparts else None
+        topart = TopArt.get_by_key_name(key)
+        if not topart and config.LEGACY_TOPART_LOOKUP:
+            # topart with numeric ID which isn't migrated by /ad/migrate/keys yet
+            toparts = TopArt.all()
+            toparts.filter('nick =', nick)
+            toparts.filter('period =', period)
+            toparts.filter('width =', w)
+            toparts.filter('height =', h)
+            toparts = toparts.fetch(1)
+            topart = toparts[0] if toparts else None
         if topart:
             #logging.info('memcache.set in get_topart')
-            memcache.set(topart.url(), topart, config.EXPIRATION_TIME)
+            cache.set(topart.url(), topart, config.EXPIRATION_TIME)
             #logging.info('new request for key=%s' % topart.key())
 
     return topart
 
 
-def cover_filter(link):
+def get_topart_image(nick, period, w, h, variant):
+    '''Return image entry of topart (see load_topart_image). Entries are kept in
+    the in-process LOCAL_IMAGES cache and trusted for config.LOCAL_CACHE_TTL
+    seconds, after that their version is checked against memcache. So updated
+    toparts are served by all instances within config.LOCAL_CACHE_TTL.
+    Variant is resolved to an encoded one first, so entries are cached only
+    under keys uncache_toparts deletes.'''
+    variant = get_stored_image_variant(variant)
+    if variant is None:
+        return None
+    key = get_topart_image_key(get_topart_url(nick, period, w, h), variant)
+    cached = LOCAL_IMAGES.get(key)
+    if cached:
+        entry, checked = cached
+        if time.time() - checked < config.LOCAL_CACHE_TTL:
+            return entry
+        current = cache.get(key)
+        if (current and current['version'] == entry['version']
+                    and current['blob'] == entry['blob']):
+            LOCAL_IMAGES.set(key, entry)
+            return entry
+
+    entry = load_topart_image(nick, period, w, h, variant)
+    if entry:
+        LOCAL_IMAGES.set(key, entry)
+    else:
+        LOCAL_IMAGES.delete(key)
+    return entry
+
+
+def load_topart_image(nick, period, w, h, variant):
+    '''Return entry of topart image variant (or the closest available one, see
+    TopArt.find_image_variant) or None if there is no such topart or image
+    scale. Entry is a dict with keys:
+        content_type, image - image type and bytes;
+        version - topart version stamp;
+        etag - image content hash;
+        last_modified - last topart update;
+        period - topart period.
+    These entries are cached separately from toparts, so serving images needs
+    neither topart deserialization nor datastore access.'''
+    url = get_topart_url(nick, period, w, h)
+    key = get_topart_image_key(url, variant)
+    entry = cache.get(key)
+    image = None
+    if entry is not None:
+        image = entry.get('image') or get_blob_image(entry['blob'], entry['variant'])
+
+    if image is None:
+        topart = get_topart(nick, period, w, h)
+        if not topart:
+            return None
+        found = topart.find_image_variant(variant)
+        if not found:
+            return None
+        image = topart.get_image(found)
+        entry = {'content_type': TOPART_FORMATS[split_image_variant(found)[0]][0],
+                 'variant': found,
+                 'blob': topart.blob_key() and topart.blob_key().name(),
+                 'version': topart.version(),
+                 'etag': hashlib.md5(image).hexdigest(),
+                 'last_modified': topart.last_upd_date,
+                 'period': topart.period}
+        if entry['blob']:
+            # image bytes are cached once for all toparts sharing the blob
+            cache.set(get_blob_image_key(entry['blob'], found), image,
+                            config.EXPIRATION_TIME)
+        else:
+            entry['image'] = image
+        cache.set(key, entry, config.EXPIRATION_TIME)
+
+    return dict(entry, image=image)
+
+
+def get_blob_image(name, variant):
+    '''Return image variant of TopArtBlob with key name or None if there is
+    no such blob.'''
+    key = get_blob_image_key(name, variant)
+    image = cache.get(key)
+    if image is None:
+        blob = TopArtBlob.get_by_key_name(name)
+        image = blob and blob.get_image(variant)
+        if image is not None:
+            cache.set(key, image, config.EXPIRATION_TIME)
+    return image
+
+
+def get_blob_image_key(name, variant):
+    return 'blob:%s.%s' % (name, variant)
+
+
+def get_topart_blob_key_name(images):
+    '''Return key name of TopArtBlob with images: content hash of all stored
+    variants, so blobs lacking some variants (e.g. migrated ones without 2x
+    images) aren't reused for complete renders with the same png.'''
+    digest = hashlib.sha1()
+    for variant in sorted(images):
+        if images[variant]:
+            digest.update('%s:%d:' % (variant, len(images[variant])))
+            digest.update(images[variant])
+    return digest.hexdigest()
+
+
+def acquire_topart_blob(images):
+    '''Return key of TopArtBlob with images from dict variant -> encoded topart.
+    The blob is keyed by content hash, so identical images share one blob, which
+    reference counter is incremented. Only the key is returned, so toparts it is
+    assigned to don't carry (and cache) the images.'''
+    key_name = get_topart_blob_key_name(images)
+
+    def acquire():
+        blob = TopArtBlob.get_by_key_name(key_name)
+        if blob:
+            blob.refs += 1
+        else:
+            blob = TopArtBlob.from_images(key_name, images)
+        return blob.put()
+
+    return db.run_in_transaction(acquire)
+
+
+def release_topart_blob(key):
+    '''Decrement reference counter of TopArtBlob and delete it when there are
+    no toparts referencing it any more.'''
+    def release():
+        blob = TopArtBlob.get(key)
+        if not blob:
+            return False
+        blob.refs -= 1
+        if blob.refs > 0:
+            blob.put()
+            return False
+        blob.delete()
+        return True
+
+    if db.run_in_transaction(release):
+        cache.delete_multi([get_blob_image_key(key.name(), variant)
+                        for variant in get_image_variants()])
+
+
+def finish_topart_updates(toparts):
+    '''Drop cached images of toparts updated by apply_update and release
+    TopArtBlobs replaced by their set_images. Toparts must be stored already,
+    otherwise requests in between would cache their previous version again.'''
+    uncache_toparts([topart.url() for topart in toparts
+                    if getattr(topart, 'updated', False)])
+    for topart in toparts:
+        topart.updated = False
+        key = getattr(topart, 'replaced_blob', None)
+        if key:
+            release_topart_blob(key)
+            topart.replaced_blob = None
+
+
+def get_topart_max_age(period):
+    '''Return time in seconds clients may cache topart image for. It depends
+    on how fast the topart period changes, so it doesn't need entries to be
+    refreshed when topart update is rescheduled.'''
+    return config.TOPART_MAX_AGE.get(period, config.TOPART_MIN_MAX_AGE)
+
+
+HTTP_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+def format_http_date(date):
+    return date.strftime(HTTP_DATE_FORMAT)
+
+
+def parse_http_date(value):
+    '''Return datetime (UTC) from http date header value or None.'''
+    parsed = value and email.utils.parsedate_tz(value)
+    if not parsed:
+        return None
+    return datetime.datetime.utcfromtimestamp(email.utils.mktime_tz(parsed))
+
+
+def get_topart_image_key(url, variant):
+    return 'image:%s.%s' % (url, variant)
+
+
+def uncache_toparts(urls):
+    '''Delete toparts and all their images from memcache and from the local
+    image cache of this instance.'''
+    keys = list(urls)
+    for url in urls:
+        keys.extend(get_topart_image_key(url, variant) for variant in get_image_variants())
+    cache.delete_multi(keys)
+    for key in keys:
+        LOCAL_IMAGES.delete(key)
+
+
+class LocalImageCache(object):
+    '''Size-bounded in-process LRU cache of topart image entries. Every item
+    is an (entry, time it was set) pair.'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.items[key] = item
+        return item
+
+    def set(self, key, entry):
+        self.delete(key)
+        size = len(entry['image'])
+        if size > self.max_bytes:
+            return
+        self.items[key] = (entry, time.time())
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest, (old_entry, _) = self.items.popitem(last=False)
+            self.bytes -= len(old_entry['image'])
+
+    def delete(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.bytes -= len(item[0]['image'])
+
+
+LOCAL_IMAGES = LocalImageCache(config.LOCAL_CACHE_SIZE)
+
+
+def cover_filter(link, bad_links=()):
 #    return link is not None and 'default_album' not in link
 #    if 'last' not in link: logging.info(link)
-    return link is not None and 'default_album' not in link and 'last' in link
+    return (link is not None and 'default_album' not in link and 'last' in link
+                and link not in bad_links)
 
 
 ERROR_RESERVE_SIZE = 10
 
 
-def get_arts_images(nick, period=pylast.PERIOD_OVERALL, num=5,
-                        size=config.COVER_SIZE):
+def get_arts_urls(nick, period=pylast.PERIOD_OVERALL, size=config.COVER_SIZE):
+    '''Return urls of user's top albums artworks that are worth fetching.'''
     net = pylast.get_lastfm_network(api_key=config.LASTFM_API_KEY)
-    images = []
+    arts_urls = []
     error = ''
 
     try:
         arts_data = net.get_user(nick).get_top_albums_with_arts(period, size)
-        arts_urls = filter(cover_filter, (data.image for data in arts_data))
-
-        for art_url in arts_urls:
-            if len(images) == num: break
-            image = get_art_image(art_url)
-            if image: images.append(image)
+        arts_urls = [data.image for data in arts_data]
+        bad_urls = get_bad_covers(filter(None, arts_urls))
+        arts_urls = [url for url in arts_urls if cover_filter(url, bad_urls)]
 
     except pylast.WSError, e:
         logging.error('Failed to fetch images: %s (user - %s)' % (e, nick))
         logging.exception(e)
         error = 'Failed to fetch artworks images.'
 
-    return images, error
+    return arts_urls, error
+
+
+def get_arts_fingerprint(urls, num):
+    '''Return fingerprint of the artworks a topart of num albums is rendered
+    from (including reserve ones) and of the rendering settings. Artworks are
+    identified by file names, which are the same for all artwork sizes, so the
+    fingerprint doesn't depend on the size toparts updated together request.'''
+    data = [str(config.ABOUT_ME_WIDTH), str(config.OUTPUT_SCALES)]
+    data.extend(url.rsplit('/', 1)[-1] for url in urls[:num + ERROR_RESERVE_SIZE])
+    return hashlib.sha1('\n'.join(data)).hexdigest()
+
+
+def fetch_arts_images(urls, num, size=config.COVER_SIZE, reserve=ERROR_RESERVE_SIZE,
+                        tile_size=None):
+    '''Download artworks concurrently (no more than config.FETCH_CONCURRENCY
+    at once) and return first num successfully fetched images keeping urls order.
+    Stop waiting as soon as these num images are known. Artworks found in the
+    cover cache are not downloaded (stale ones are revalidated), new ones are
+    added to the cache. Broken artworks are added to the negative cover cache.
+
+    Besides num required artworks up to reserve next candidates are downloaded
+    in background, so failed artworks are replaced without extra round-trips.
+    Reserve artworks fetched before the grid is complete are cached, unfinished
+    reserve downloads are abandoned.
+
+    If tile_size is passed images are decoded at the smallest resolution that
+    still covers tile_size x tile_size square (see open_art_image) and returned
+    as ready-to-paste tiles. Tiles found in the tile store skip both download
+    and decoding, new ones are added to the store.'''
+    images = {}
+    failed = set()
+    rpcs = {}
+    fetched = {}
+    broken = []
+    window = urls[:num + reserve]
+    tiles = get_cached_tiles(window, tile_size) if tile_size else {}
+    cached = get_cached_covers([url for url in window if url not in tiles], size)
+    candidates = list(enumerate(urls))
+    candidates.reverse()
+
+    tiled = set()
+    new_tiles = {}
+    while True:
+        while not arts_ready(len(urls), images, failed, num):
+            while (candidates and len(rpcs) < config.FETCH_CONCURRENCY
+                        and len(rpcs) + len(images) < num + reserve):
+                index, url = candidates.pop()
+                if index >= num + reserve:
+                    if tile_size:
+                        tiles.update(get_cached_tiles([url], tile_size))
+                    if url not in tiles:
+                        cached.update(get_cached_covers([url], size))
+                if url in tiles:
+                    images[index] = tiles[url]
+                    continue
+                cover = cached.get(url)
+                if cover and not cover.is_stale():
+                    image = open_art_image(cover.data, url, tile_size)
+                    if image:
+                        images[index] = image
+                    else:
+                        failed.add(index)
+                else:
+                    rpcs[start_art_fetch(url, cover)] = (index, url)
+
+            if not rpcs: break
+
+            rpc = apiproxy_stub_map.UserRPC.wait_any(rpcs.keys())
+            index, url = rpcs.pop(rpc)
+            cover = read_art_cover(rpc, url, size, cached.get(url))
+            image = open_art_image(cover.data, url, tile_size) if cover else None
+            if image:
+                images[index] = image
+                if not cover.is_stale():
+                    fetched[url] = cover
+            else:
+                failed.add(index)
+                broken.append(url)
+
+        if not tile_size:
+            break
+        # artworks are decoded only here, so ones with valid header but corrupt
+        # data are found late and replaced by the next candidates
+        corrupt = False
+        for index in sorted(images)[:num]:
+            url = urls[index]
+            if index in tiled or url in tiles:
+                continue
+            tile = cut_art_tile(images[index], url, tile_size)
+            if tile is None:
+                del images[index]
+                fetched.pop(url, None)
+                failed.add(index)
+                broken.append(url)
+                corrupt = True
+            else:
+                images[index] = new_tiles[url] = tile
+                tiled.add(index)
+        if not corrupt:
+            break
+
+    cache_covers(fetched.values())
+    mark_bad_covers(broken)
+    cache_tiles(new_tiles, tile_size)
+
+    selected = sorted(images)[:num]
+    return [images[index] for index in selected]
 
 
-def get_art_image(url):
+def cut_art_tile(image, url, tile_size):
+    '''Return tile cut from artwork image (see make_tile) or None if image data
+    is corrupt.'''
     try:
-        return Image.open(StringIO(urlfetch.Fetch(url).content))
-    except (IOError, DownloadError), e:
+        return make_tile(image, tile_size)
+    except IOError, e:
+        logging.error('Failed to decode image: %s (url - "%s")' % (e, url))
+        logging.exception(e)
+        return None
+
+
+def arts_ready(total, images, failed, num):
+    '''Return True if first num good images (in urls order) are already fetched
+    or there is nothing left to wait for.'''
+    found = 0
+    for index in xrange(total):
+        if index in images:
+            found += 1
+            if found == num: return True
+        elif index not in failed:
+            return False
+    return True
+
+
+def start_art_fetch(url, cover=None):
+    '''Start asynchronous artwork download and return its rpc. If cached cover
+    is passed the download is conditional on its validators. No more than
+    config.COVER_MAX_BYTES + 1 bytes are requested, so oversized artworks are
+    detected without transferring them completely.'''
+    headers = {'Range': 'bytes=0-%d' % config.COVER_MAX_BYTES}
+    if cover and cover.etag:
+        headers['If-None-Match'] = cover.etag
+    if cover and cover.last_modified:
+        headers['If-Modified-Since'] = cover.last_modified
+
+    rpc = urlfetch.create_rpc(deadline=config.FETCH_DEADLINE)
+    urlfetch.make_fetch_call(rpc, url, headers=headers)
+    return rpc
+
+
+def read_art_cover(rpc, url, size, cover=None):
+    '''Wait for artwork download started by start_art_fetch and return CoverArt
+    with its content. Return revalidated cover if the artwork was not modified
+    and the cover as is (still stale) if it couldn't be revalidated.'''
+    try:
+        result = rpc.get_result()
+    except DownloadError, e:
         logging.error('Failed to fetch image: %s (url - "%s")' % (e, url))
         logging.exception(e)
+        return get_stale_cover(cover)
+
+    now = datetime.datetime.now()
+
+    if result.status_code == 304 and cover:
+        count_cover_stat('revalidated')
+        cover.validated = now
+        return cover
+
+    if result.status_code not in (200, 206):
+        logging.error('Failed to fetch image: status %d (url - "%s")' % (result.status_code, url))
+        return get_stale_cover(cover)
+
+    # servers ignoring Range send the whole artwork, so check the length anyway
+    if len(result.content) > config.COVER_MAX_BYTES:
+        count_cover_stat('rejected_bytes')
+        logging.error('Rejected image: more than %d bytes (url - "%s")' % (config.COVER_MAX_BYTES, url))
+        return None
+
+    return CoverArt(key_name=cover_key_name(url, size), url=url, size=size,
+                    data=result.content, bytes=len(result.content),
+                    etag=result.headers.get('ETag'),
+                    last_modified=result.headers.get('Last-Modified'),
+                    validated=now)
+
+
+def get_stale_cover(cover):
+    '''Return cached cover which failed to be revalidated, so artworks stay in
+    toparts while last.fm is unavailable.'''
+    if cover:
+        count_cover_stat('stale_served')
+    return cover
+
+
+def open_art_image(data, url, tile_size=None):
+    '''Open artwork image. If tile_size is passed ask PIL to decode JPEG at the
+    smallest draft scale (1/2, 1/4 or 1/8) that still covers tile_size x tile_size
+    square, which is much cheaper than decoding the full image.
+
+    Image.open reads only the header, so images of unexpected format or
+    dimensions are rejected before any decoding.'''
+    try:
+        image = Image.open(StringIO(data))
+        if image.format not in config.COVER_FORMATS:
+            count_cover_stat('rejected_format')
+            logging.error('Rejected image: format %s (url - "%s")' % (image.format, url))
+            return None
+        if max(image.size) > config.COVER_MAX_DIMENSION or min(image.size) < 1:
+            count_cover_stat('rejected_dimensions')
+            logging.error('Rejected image: size %dx%d (url - "%s")' % (image.size + (url,)))
+            return None
+        if tile_size:
+            image.draft(image.mode, (tile_size, tile_size))
+        return image
+    except IOError, e:
+        logging.error('Failed to open image: %s (url - "%s")' % (e, url))
+        logging.exception(e)
+
+
+# Cover cache
+
+# Prefix of memcache keys of cached covers (followed by CoverArt key name)
+COVER_CACHE_PREFIX = 'coverdata:'
+
+
+def cover_key_name(url, size):
+    '''Return CoverArt key name for artwork url of the specific pylast size.'''
+    return 'cover:%d:%s' % (size, hashlib.md5(url).hexdigest())
+
+
+def dump_cover(cover):
+    '''Return memcache value of CoverArt: raw bytes and validators, which are
+    much smaller and cheaper to unpickle than the entity.'''
+    return (cover.data, cover.etag, cover.last_modified, cover.validated)
+
+
+def load_cover(name, url, size, value):
+    '''Return CoverArt (not stored) from memcache value made by dump_cover.'''
+    data, etag, last_modified, validated = value
+    return CoverArt(key_name=name, url=url, size=size, data=data, bytes=len(data),
+                    etag=etag, last_modified=last_modified, validated=validated)
+
+
+def get_cached_covers(urls, size):
+    '''Return dict url -> CoverArt for artworks found in the cover cache.
+    Look into memcache first and into the datastore for the rest.'''
+    if not urls:
+        return {}
+
+    names = dict((cover_key_name(url, size), url) for url in urls)
+    found = cache.get_multi(names.keys(), key_prefix=COVER_CACHE_PREFIX)
+    covers = dict((names[name], load_cover(name, names[name], size, value))
+                    for name, value in found.iteritems())
+
+    missing = [name for name in names if name not in found]
+    if missing:
+        now = datetime.datetime.now()
+        touched = []
+        stored = {}
+        for name, cover in zip(missing, CoverArt.get_by_key_name(missing)):
+            if cover:
+                covers[names[name]] = cover
+                stored[name] = dump_cover(cover)
+                if now - cover.last_access > config.COVER_TOUCH_INTERVAL:
+                    cover.last_access = now
+                    touched.append(cover)
+        if stored:
+            cache.set_multi(stored, config.EXPIRATION_TIME, key_prefix=COVER_CACHE_PREFIX)
+        if touched:
+            db.put(touched)
+        count_cover_stat('datastore_hits', len(stored))
+
+    count_cover_stat('memcache_hits', len(found))
+    count_cover_stat('misses', len(urls) - len(covers))
+
+    return covers
+
+
+def cache_covers(covers):
+    '''Put fresh downloaded or revalidated CoverArt entities to both memcache
+    and datastore tiers of the cover cache.'''
+    if not covers:
+        return
+
+    cache.set_multi(dict((cover.key().name(), dump_cover(cover)) for cover in covers),
+                        config.EXPIRATION_TIME, key_prefix=COVER_CACHE_PREFIX)
+    for start in xrange(0, len(covers), config.BATCH_PUT_LIMIT):
+        db.put(covers[start:start + config.BATCH_PUT_LIMIT])
+
+
+def evict_covers():
+    '''Keep datastore tier of the cover cache under config.COVER_CACHE_LIMIT bytes
+    deleting least recently used artworks. Return number of deleted artworks.'''
+    covers = db.Query(CoverArt, projection=('bytes', 'last_access'))
+    covers = covers.order('-last_access')
+
+    total = 0
+    evicted = []
+    for cover in covers.run(batch_size=1000):
+        total += cover.bytes or 0
+        if total > config.COVER_CACHE_LIMIT:
+            evicted.append(cover.key())
+
+    for start in xrange(0, len(evicted), config.BATCH_PUT_LIMIT):
+        batch = evicted[start:start + config.BATCH_PUT_LIMIT]
+        db.delete(batch)
+        cache.delete_multi([key.name() for key in batch], key_prefix=COVER_CACHE_PREFIX)
+
+    return len(evicted)
+
+
+# Tile store
+
+def tile_key_name(url, tile_size):
+    '''Return memcache key of the artwork tile of the specific size.'''
+    return 'tile:%d:%s' % (tile_size, hashlib.md5(url).hexdigest())
+
+
+def get_cached_tiles(urls, tile_size):
+    '''Return dict url -> tile image for artworks already cut to tile_size.'''
+    if not urls:
+        return {}
+
+    names = dict((tile_key_name(url, tile_size), url) for url in urls)
+    found = cache.get_multi(names.keys())
+    tiles = {}
+    for name, data in found.iteritems():
+        tile = open_art_image(data, names[name])
+        if tile:
+            tiles[names[name]] = tile
+
+    count_cover_stat('tile_hits', len(tiles))
+
+    return tiles
+
+
+def cache_tiles(tiles, tile_size):
+    '''Put dict url -> tile image to the tile store. Tiles are stored as PNG
+    which is compact and lossless for tiles pasted into PNG toparts.'''
+    if not tiles:
+        return
+
+    encoded = {}
+    for url, tile in tiles.iteritems():
+        output = StringIO()
+        tile.save(output, format='PNG')
+        encoded[tile_key_name(url, tile_size)] = output.getvalue()
+        output.close()
+
+    cache.set_multi(encoded, config.EXPIRATION_TIME)
+
+
+def bad_cover_key(url):
+    '''Return memcache key of the negative cover cache entry of artwork url.'''
+    return 'badart:' + hashlib.md5(url).hexdigest()
+
+
+def get_bad_covers(urls):
+    '''Return set of artwork urls that failed recently and should be skipped.'''
+    names = dict((bad_cover_key(url), url) for url in urls)
+    found = cache.get_multi(names.keys()) if names else {}
+    now = time.time()
+    bad = set(names[name] for name, (count, skip_until) in found.iteritems()
+                    if skip_until > now)
+    count_cover_stat('bad_skips', len(bad))
+    return bad
+
+
+def mark_bad_covers(urls):
+    '''Add broken artwork urls to the negative cover cache. Every next failure
+    of the same url doubles the time it is skipped for (up to config.BAD_COVER_MAX_TTL).
+    Entries are (failures count, time to skip url until) and outlive the skip,
+    so the count is still known when the url fails again.'''
+    if not urls:
+        return
+
+    names = dict((bad_cover_key(url), url) for url in urls)
+    failures = cache.get_multi(names.keys())
+    now = time.time()
+    for name in names:
+        count = failures.get(name, (0, 0))[0] + 1
+        ttl = min(config.BAD_COVER_TTL * 2 ** (count - 1), config.BAD_COVER_MAX_TTL)
+        cache.set(name, (count, now + ttl), config.BAD_COVER_MAX_TTL * 2)
+        logging.info('BAD cover (failures=%d, ttl=%d): %s' % (count, ttl, names[name]))
+
+
+COVER_STATS = ('memcache_hits', 'datastore_hits', 'misses', 'bad_skips', 'revalidated',
+                        'tile_hits', 'rejected_bytes', 'rejected_format',
+                        'rejected_dimensions', 'stale_served')
+
+
+def count_cover_stat(name, delta=1):
+    if delta:
+        cache.incr('cover_stats:' + name, delta, initial_value=0)
+
+
+def cover_cache_stats():
+    '''Return dict with cover cache hit/miss counters.'''
+    stats = cache.get_multi(COVER_STATS, key_prefix='cover_stats:')
+    return dict((name, stats.get(name, 0)) for name in COVER_STATS)
 
 
 def generate_topart(nick, period, width, height):
-    size = config.ABOUT_ME_WIDTH // width
-    req_size = opt_size(size)
+    '''Return (images, error, fingerprint) where images is dict image variant ->
+    encoded topart rendered in every scale of config.OUTPUT_SCALES from the same
+    covers, fetched once for the largest scale, and fingerprint is the one of
+    the album list (see get_arts_fingerprint).'''
+    return generate_toparts(nick, period, [(width, height)])[(width, height)]
+
+
+def generate_toparts(nick, period, grids, fingerprints=None):
+    '''Render toparts of the same nick and period for every (width, height) of
+    grids from one album list and one covers fetch (for the largest tile and
+    grid). Return dict (width, height) -> (images, error, fingerprint) where
+    images are like the ones returned by generate_topart and fingerprint is
+    the one of the album list (see get_arts_fingerprint).
+
+    Grids with fingerprint equal to the one in dict fingerprints aren't
+    rendered at all, their images are None.'''
+    failed = dict((grid, (None, 'Topart generation failed', None)) for grid in grids)
+    sizes = dict((grid, config.ABOUT_ME_WIDTH // grid[0]) for grid in grids)
+    max_size = max(sizes.values()) * max(config.OUTPUT_SCALES)
+    req_size = opt_size(max_size)
+
+    arts_urls, error = get_arts_urls(nick, period, req_size)
+    if error:
+        return failed
+
+    toparts = {}
+    for grid in grids:
+        fingerprint = get_arts_fingerprint(arts_urls, grid[0] * grid[1])
+        if fingerprints and fingerprints.get(grid) == fingerprint:
+            toparts[grid] = (None, '', fingerprint)
+        else:
+            toparts[grid] = ({}, '', fingerprint)
 
-    error = ''
-    topart = None
+    changed = [grid for grid in grids if toparts[grid][0] is not None]
+    if not changed:
+        return toparts
+
+    max_size = max(sizes[grid] for grid in changed) * max(config.OUTPUT_SCALES)
+    num = max(width * height for width, height in changed)
+    images = fetch_arts_images(arts_urls, num, req_size, tile_size=max_size)
 
-    images, error = get_arts_images(nick, period, width * height, req_size)
+    if not images:
+        toparts.update((grid, failed[grid]) for grid in changed)
+        return toparts
 
-    if images and not error:
+    renders = []
+    for grid in changed:
+        width, height = grid
         if len(images) < width * height:
             if len(images) >= width:
                 height = len(images) // width
-                images = images[:width * height]
             else:
                 height = 1
                 width = len(images)
-
-        canvas = Image.new('RGBA', (size * width, size * height))
-
-        for index, image in enumerate(images):
-            append_image(canvas, image, index, width, size)
+        for scale in config.OUTPUT_SCALES:
+            renders.append((sizes[grid] * scale, scale, grid, width, height))
+
+    # compose shrinks images in place, so the largest tiles go first
+    for size, scale, grid, width, height in sorted(renders, reverse=True):
+        canvas = compositor.compose(images[:width * height], width, height, size,
+                        config.NUMPY_COMPOSITOR)
+        formats = TOPART_FORMATS if scale == 1 else config.SCALED_FORMATS
+        suffix = get_scale_suffix(scale)
+        for format, image in encode_topart(canvas, formats).iteritems():
+            toparts[grid][0][format + suffix] = image
+
+    return toparts
+
+
+def encode_topart(canvas, formats=TOPART_FORMATS):
+    '''Return dict format -> canvas encoded in every format of formats supported
+    by PIL. PNG is always present if requested.'''
+    images = {}
+    for format in formats:
+        pil_format = TOPART_FORMATS[format][1]
+        image = canvas
+        options = {}
+        if format == 'jpg':
+            image = canvas.convert('RGB')
+            options['quality'] = config.JPEG_QUALITY
+        elif format == 'webp':
+            options['quality'] = config.WEBP_QUALITY
 
         output = StringIO()
-        canvas.save(output, format="PNG")
-        topart = output.getvalue()
+        try:
+            image.save(output, format=pil_format, **options)
+            images[format] = output.getvalue()
+        except (IOError, KeyError), e:
+            if format == 'png':
+                raise
+            logging.warning('Failed to encode topart as %s: %s' % (pil_format, e))
         output.close()
-    else:
-        error = 'Topart generation failed'
-
-    return topart, error
-
-
-def append_image(canvas, image, index, width, size):
-    left = (index % width) * size
-    top = (index // width) * size
 
-    image.thumbnail((size, 'auto'))
-    canvas.paste(image.crop((0, 0, size, size)), (left, top))
+    return images
 
 
 def opt_size(size):
@@ -507,13 +1698,19 @@ application = webapp.WSGIApplication(
                         [
                             ('/', MainPage),
                             ('/faq', FAQ),
-                            ('/update/(\d+)', UpdateTopArt),
-                            ('/ad/update/(\d+)', UpdateTopArtTask),
+                            ('/update/([\w-]+)', UpdateTopArt),
                             ('/ad/update/all', UpdateAllTopArts),
+                            ('/ad/update/group', UpdateTopArtGroupTask),
+                            ('/ad/update/slice', UpdateSlice),
+                            ('/ad/update/([\w-]+)', UpdateTopArtTask),
                             ('/ad/reset/all', ResetAllWaitingUpdates),
-                            ('/delete/(\d+)', DeleteTopArt),
+                            ('/ad/covers/evict', EvictCovers),
+                            ('/ad/migrate/(keys|images|schedule)', MigrateTopArts),
+                            ('/delete/([\w-]+)', DeleteTopArt),
                             ('/toparts', ManageTopArts),
-                            ('/topart/(.*)/(.*)/(\d+)x(\d+).png', TopArtImage),
+                            ('/topart/(.*)/(.*)/(\d+)x(\d+)(@\dx)?\.([0-9a-f]+)\.(png|jpg|webp)',
+                                VersionedTopArtImage),
+                            ('/topart/(.*)/(.*)/(\d+)x(\d+)(@\dx)?\.(png|jpg|webp)', TopArtImage),
                             ('/topart/(.*)/(.*)/(\d+)x(\d+)', TopArtPage),
                             ('/permissions', Permissions),
                             ('/permission/delete/(\d+)', DeletePermission)
@@ -0,0 +1,102 @@
+#!usr/bin/env python
+# Author: Kirill Lashuk
+
+'''Run coverfm outside of App Engine with local backends (see backends.local):
+
+    python standalone.py [port]             - built-in server;
+    gunicorn -w 1 standalone:application    - gunicorn server.
+
+Only one process may serve the application: the SQLite datastore stub keeps
+transactions and consistency within its process, and task names are
+deduplicated per process (see backends.local). Don't run several workers.
+
+App Engine SDK must be importable or its path set in APPENGINE_SDK. Requests
+from local clients act as admin COVERFM_ADMIN (email) if it is set. There is
+no cron locally, so request /ad/update/all from the host cron or a load
+testing tool.'''
+
+import os
+import sys
+import mimetypes
+import threading
+
+os.environ['COVERFM_BACKEND'] = 'local'
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from backends import local
+local.setup_stubs()
+
+import coverfm
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Static handlers of app.yaml: url prefix -> directory
+STATIC_DIRS = {
+    '/css/': 'static/css',
+    '/js/': 'static/js',
+    '/images/': 'static/images',
+}
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# coverfm isn't threadsafe (see app.yaml), so every process serves requests
+# and runs tasks one at a time
+APP_LOCK = threading.Lock()
+
+
+def application(environ, start_response):
+    '''Serve static files and coverfm requests. /ad/ urls (login: admin in
+    app.yaml) are allowed for local clients only, the same clients act as
+    COVERFM_ADMIN.'''
+    path = environ.get('PATH_INFO', '')
+    is_local = environ.get('REMOTE_ADDR') in LOCAL_ADDRESSES
+
+    for prefix, directory in STATIC_DIRS.iteritems():
+        if path.startswith(prefix):
+            return serve_static(os.path.join(directory, path[len(prefix):]), start_response)
+
+    if path.startswith('/ad/') and not is_local:
+        start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+        return ['Forbidden']
+
+    with APP_LOCK:
+        # users API reads the current user from os.environ
+        if is_local and os.environ.get('COVERFM_ADMIN'):
+            os.environ['USER_EMAIL'] = os.environ['COVERFM_ADMIN']
+            os.environ['USER_IS_ADMIN'] = '1'
+        else:
+            os.environ.pop('USER_EMAIL', None)
+            os.environ.pop('USER_IS_ADMIN', None)
+        return coverfm.application(environ, start_response)
+
+
+# tasks are run through the same lock and static handlers as requests
+local.tasks.application = application
+
+
+def serve_static(path, start_response):
+    path = os.path.normpath(os.path.join(ROOT_DIR, path))
+    if not path.startswith(ROOT_DIR + os.sep) or not os.path.isfile(path):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not found']
+
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    start_response('200 OK', [('Content-Type', content_type)])
+    with open(path, 'rb') as static_file:
+        return [static_file.read()]
+
+
+def main():
+    from wsgiref.simple_server import make_server
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    print 'Serving coverfm on http://localhost:%d/' % port
+    make_server('', port, application).serve_forever()
+
+
+if __name__ == '__main__':
+    main()